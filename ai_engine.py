@@ -5,69 +5,308 @@ Búsqueda inteligente + OpenAI para respuestas precisas
 
 import os
 import re
+import json
+import asyncio
+import unicodedata
+import httpx
+import xxhash
+import orjson
+import diskcache
+import redis.asyncio as redis
+import numpy as np
+from functools import lru_cache
+from cachetools import TTLCache, LRUCache
+from rapidfuzz import process, fuzz, utils
 from openai import AsyncOpenAI
-from database import get_session, buscar_programas, Programa, Materia
-from sqlalchemy import or_, func
+from database import get_session, buscar_programas_por_texto, CARGAR_MATERIAS, Programa, EmbeddingPrograma
+from sqlalchemy import func
+from sqlalchemy.orm import load_only
 import logging
 
 logger = logging.getLogger(__name__)
 
-client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# Un solo pool HTTP/2 compartido por todas las llamadas a OpenAI
+client = AsyncOpenAI(
+    api_key=os.getenv('OPENAI_API_KEY'),
+    http_client=httpx.AsyncClient(
+        http2=True,
+        # La conexión ociosa se mantiene 60s: entre consultas no se repite el handshake TLS
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60),
+        timeout=httpx.Timeout(30, connect=5)
+    )
+)
+
+# Respuestas ya generadas por pregunta normalizada: (respuesta, programa, tokens)
+RESP_CACHE = TTLCache(maxsize=2048, ttl=3600)
+
+# Segundo nivel, compartido entre workers y persistente entre deploys:
+# Redis si hay REDIS_URL, si no un diskcache local
+CACHE_COMPARTIDA_TTL = 86400
+REDIS_URL = os.getenv('REDIS_URL')
+cache_redis = redis.from_url(REDIS_URL) if REDIS_URL else None
+cache_disco = None if REDIS_URL else diskcache.Cache(os.getenv('RESP_CACHE_DIR', '/tmp/uba'))
+
+_PUNTUACION = re.compile(r'[^\w\s]')
+
+def sin_acentos(texto: str) -> str:
+    """Quita tildes y diéresis (como remove_diacritics del FTS); la ñ se conserva"""
+    descompuesto = unicodedata.normalize('NFKD', texto)
+    return unicodedata.normalize('NFC', ''.join(
+        c for c in descompuesto if c == '\u0303' or not unicodedata.combining(c)
+    ))
+
+def normalizar_pregunta(pregunta: str) -> str:
+    """Clave de cache: minúsculas, sin tildes ni signos de puntuación y espacios colapsados"""
+    return ' '.join(_PUNTUACION.sub(' ', sin_acentos(pregunta.lower())).split())
+
+def _clave_compartida(pregunta_normalizada: str) -> str:
+    return 'q:' + xxhash.xxh3_128_hexdigest(pregunta_normalizada)
+
+async def leer_respuesta_cacheada(pregunta_normalizada: str):
+    """(respuesta, programa, tokens) desde la cache local o la compartida; None si no está"""
+    cacheada = RESP_CACHE.get(pregunta_normalizada)
+    if cacheada:
+        return cacheada
+    
+    clave = _clave_compartida(pregunta_normalizada)
+    try:
+        if cache_redis:
+            datos = await cache_redis.get(clave)
+        else:
+            datos = await asyncio.to_thread(cache_disco.get, clave)
+    except Exception as e:
+        logger.warning("Cache compartida no disponible: %s", e)
+        return None
+    
+    if not datos:
+        return None
+    
+    cacheada = RESP_CACHE[pregunta_normalizada] = tuple(orjson.loads(datos))
+    return cacheada
+
+async def guardar_respuesta_cacheada(pregunta_normalizada: str, valor: tuple):
+    """Guarda (respuesta, programa, tokens) en la cache local y la compartida"""
+    RESP_CACHE[pregunta_normalizada] = valor
+    
+    vector = EMB_CACHE.get(pregunta_normalizada)
+    if vector is not None:
+        PREGUNTAS_RESPONDIDAS[pregunta_normalizada] = vector
+    
+    clave = _clave_compartida(pregunta_normalizada)
+    datos = orjson.dumps(valor)
+    try:
+        if cache_redis:
+            await cache_redis.setex(clave, CACHE_COMPARTIDA_TTL, datos)
+        else:
+            await asyncio.to_thread(cache_disco.set, clave, datos, expire=CACHE_COMPARTIDA_TTL)
+    except Exception as e:
+        logger.warning("No se pudo guardar en la cache compartida: %s", e)
+
+# ============== EMBEDDINGS ==============
+
+EMBEDDING_MODELO = "text-embedding-3-small"
+UMBRAL_SIMILITUD = 0.4  # coseno mínimo para confiar en el match semántico
+# Ventaja mínima sobre el segundo programa: preguntas genéricas quedan cerca
+# de varios programas a la vez y no deben elegir uno al azar
+MARGEN_SIMILITUD = 0.05
+
+# Embeddings de preguntas ya vistas (pregunta normalizada -> bytes float32)
+EMB_CACHE = LRUCache(maxsize=4096)
+
+def texto_para_embedding(programa) -> str:
+    """Texto que representa a un programa en la búsqueda semántica"""
+    return f"{programa.nombre or ''}\n{(programa.objetivos or '')[:1000]}"
+
+async def embeber(textos: list) -> list:
+    """Embeddings normalizados (norma 1) como bytes float32, uno por texto"""
+    response = await client.embeddings.create(model=EMBEDDING_MODELO, input=textos)
+    vectores = []
+    for item in response.data:
+        v = np.asarray(item.embedding, dtype=np.float32)
+        vectores.append((v / np.linalg.norm(v)).tobytes())
+    return vectores
+
+@lru_cache(maxsize=1)
+def cargar_embeddings() -> tuple:
+    """
+    (ids, matriz) de los embeddings de programas; se lee una vez por proceso
+    Un programa re-scrapeado queda en varias filas: se usa solo la más nueva,
+    para que el margen contra el segundo no compare un programa consigo mismo
+    """
+    with get_session() as session:
+        filas = session.query(
+            EmbeddingPrograma.programa_id, EmbeddingPrograma.vector,
+            Programa.nombre_corto, Programa.nombre
+        ).join(Programa, Programa.id == EmbeddingPrograma.programa_id).filter(
+            EmbeddingPrograma.modelo == EMBEDDING_MODELO
+        ).order_by(EmbeddingPrograma.programa_id).all()
+    if not filas:
+        return [], None
+    ultimas = {f.nombre_corto or f.nombre: f for f in filas}
+    ids = [f.programa_id for f in ultimas.values()]
+    matriz = np.vstack([np.frombuffer(f.vector, dtype=np.float32) for f in ultimas.values()])
+    return ids, matriz
+
+async def embedding_pregunta(pregunta_normalizada: str):
+    """Embedding de la pregunta (cacheado); None si no hay programas embebidos o falla la API"""
+    if pregunta_normalizada in EMB_CACHE:
+        return EMB_CACHE[pregunta_normalizada]
+    
+    ids, _ = await asyncio.to_thread(cargar_embeddings)
+    if not ids:
+        return None
+    
+    try:
+        vector = (await embeber([pregunta_normalizada]))[0]
+    except Exception as e:
+        logger.warning("No se pudo calcular el embedding de la pregunta: %s", e)
+        return None
+    
+    EMB_CACHE[pregunta_normalizada] = vector
+    return vector
+
+# Preguntas con respuesta cacheada y su embedding, para reconocer reformulaciones
+PREGUNTAS_RESPONDIDAS = LRUCache(maxsize=1024)
+UMBRAL_MISMA_PREGUNTA = 0.95
+
+async def respuesta_similar(pregunta_normalizada: str):
+    """
+    Respuesta cacheada de una pregunta casi idéntica ("qué maestrías hay" /
+    "que maestrias hay?"); None si no hay ninguna por encima de UMBRAL_MISMA_PREGUNTA
+    """
+    if not PREGUNTAS_RESPONDIDAS:
+        return None
+    
+    vector = await embedding_pregunta(pregunta_normalizada)
+    if vector is None:
+        return None
+    
+    # Armar la matriz y compararla es CPU: va a un thread para no frenar el event loop
+    # (la copia se hace acá: la LRUCache no es thread-safe)
+    respondidas = list(PREGUNTAS_RESPONDIDAS.items())
+    parecida = await asyncio.to_thread(_pregunta_mas_parecida, vector, respondidas)
+    return await leer_respuesta_cacheada(parecida) if parecida else None
+
+def _pregunta_mas_parecida(vector: bytes, respondidas: list):
+    """Clave de la pregunta respondida más cercana si supera UMBRAL_MISMA_PREGUNTA"""
+    claves = [clave for clave, _ in respondidas]
+    matriz = np.vstack([np.frombuffer(v, dtype=np.float32) for _, v in respondidas])
+    similitudes = matriz @ np.frombuffer(vector, dtype=np.float32)
+    mejor = int(np.argmax(similitudes))
+    return claves[mejor] if similitudes[mejor] >= UMBRAL_MISMA_PREGUNTA else None
+
+def programa_mas_similar(vector: bytes):
+    """
+    Id del programa más cercano (coseno) si supera UMBRAL_SIMILITUD y le saca
+    al menos MARGEN_SIMILITUD al segundo
+    """
+    ids, matriz = cargar_embeddings()
+    if not ids:
+        return None
+    
+    similitudes = matriz @ np.frombuffer(vector, dtype=np.float32)
+    mejor = int(np.argmax(similitudes))
+    if similitudes[mejor] < UMBRAL_SIMILITUD:
+        return None
+    if len(ids) > 1:
+        segundo = np.partition(similitudes, -2)[-2]
+        if similitudes[mejor] - segundo < MARGEN_SIMILITUD:
+            return None
+    return ids[mejor]
 
 # ============== RAG - BÚSQUEDA INTELIGENTE ==============
 
-def buscar_programa_relevante(query: str, session) -> dict:
+# Palabras clave para identificar área
+AREAS = {
+    'penal': ['penal', 'criminal', 'delito', 'pena'],
+    'civil': ['civil', 'contratos', 'obligaciones'],
+    'laboral': ['trabajo', 'laboral', 'empleado', 'sindicato'],
+    'familia': ['familia', 'divorcio', 'adopción', 'alimentos'],
+    'tributario': ['tributario', 'impuesto', 'fiscal', 'afip'],
+    'internacional': ['internacional', 'tratados', 'extranjero'],
+    'administrativo': ['administrativo', 'estado', 'público'],
+    'procesal': ['procesal', 'proceso', 'juicio'],
+    'ambiental': ['ambiental', 'ambiente', 'ecología'],
+}
+
+# Una alternación compilada por área (se arma una sola vez al importar)
+AREAS_RX = {
+    area: re.compile('|'.join(re.escape(sin_acentos(k)) for k in keywords))
+    for area, keywords in AREAS.items()
+}
+
+MAX_MATERIAS_CONTEXTO = 20
+
+# Columnas de Programa que usa el contexto del RAG
+CAMPOS_CONTEXTO = (
+    Programa.id, Programa.nombre, Programa.tipo,
+    Programa.director, Programa.subdirector, Programa.coordinador, Programa.email,
+    Programa.duracion_años, Programa.carga_horaria_total, Programa.modalidad,
+    Programa.horario_cursada, Programa.objetivos, Programa.requisitos
+)
+
+def _procesar_fuzzy(texto: str) -> str:
+    """Procesador de rapidfuzz que además ignora tildes (la consulta llega sin ellas)"""
+    return utils.default_process(sin_acentos(texto))
+
+def materias_relevantes(query: str, materias: list, limit: int = MAX_MATERIAS_CONTEXTO) -> list:
+    """
+    Las `limit` materias cuyo nombre más se parece a la consulta
+    (en el orden original del plan)
+    """
+    if len(materias) <= limit:
+        return materias
+    
+    mejores = process.extract(
+        query,
+        [m.nombre or '' for m in materias],
+        scorer=fuzz.partial_ratio,
+        processor=_procesar_fuzzy,
+        limit=limit
+    )
+    return [materias[i] for i in sorted(indice for _, _, indice in mejores)]
+
+def buscar_programa_relevante(query: str, session, vector: bytes = None) -> dict:
     """
     Búsqueda semántica en BD antes de preguntar a IA
     Retorna datos estructurados del programa más relevante
+    
+    vector: embedding de la pregunta; se usa si la búsqueda por texto no encuentra nada
     """
     
     # Limpiar query
-    query_lower = query.lower()
-    
-    # Palabras clave para identificar área
-    areas = {
-        'penal': ['penal', 'criminal', 'delito', 'pena'],
-        'civil': ['civil', 'contratos', 'obligaciones'],
-        'laboral': ['trabajo', 'laboral', 'empleado', 'sindicato'],
-        'familia': ['familia', 'divorcio', 'adopción', 'alimentos'],
-        'tributario': ['tributario', 'impuesto', 'fiscal', 'afip'],
-        'internacional': ['internacional', 'tratados', 'extranjero'],
-        'administrativo': ['administrativo', 'estado', 'público'],
-        'procesal': ['procesal', 'proceso', 'juicio'],
-        'ambiental': ['ambiental', 'ambiente', 'ecología'],
-    }
+    query_lower = sin_acentos(query.casefold())
     
-    # Detectar área
-    area_detectada = None
-    for area, keywords in areas.items():
-        if any(kw in query_lower for kw in keywords):
-            area_detectada = area
-            break
-    
-    # Buscar en BD
-    programas = session.query(Programa).filter(
-        or_(
-            Programa.nombre.ilike(f'%{query}%'),
-            Programa.director.ilike(f'%{query}%'),
-            Programa.coordinador.ilike(f'%{query}%')
-        )
-    ).all()
+    # Detectar área (en el orden de AREAS)
+    area_detectada = next(
+        (area for area, rx in AREAS_RX.items() if rx.search(query_lower)),
+        None
+    )
+    
+    q = session.query(Programa).options(CARGAR_MATERIAS, load_only(*CAMPOS_CONTEXTO))
+    
+    # Buscar en BD (índice FTS, ordenado por relevancia) - solo el primero, con sus materias
+    programas = buscar_programas_por_texto(session, query, q, limit=1)
+    programa = programas[0] if programas else None
+    
+    # Búsqueda semántica (embeddings) si el texto no matcheó: umbral y margen
+    # sobre el segundo dejan sin programa a las preguntas genéricas
+    if not programa and vector:
+        programa_id = programa_mas_similar(vector)
+        if programa_id:
+            programa = q.filter(Programa.id == programa_id).first()
     
     # Si no encuentra nada, buscar por área detectada
-    if not programas and area_detectada:
-        programas = session.query(Programa).filter(
+    if not programa and area_detectada:
+        programa = q.filter(
             Programa.nombre.ilike(f'%{area_detectada}%')
-        ).all()
+        ).first()
     
-    if not programas:
+    if not programa:
         return None
     
-    # Tomar el primer resultado (más relevante)
-    programa = programas[0]
-    
-    # Obtener materias del programa
-    materias = session.query(Materia).filter_by(programa_id=programa.id).all()
+    materias = programa.materias
+    relevantes = materias_relevantes(query, materias)
     
     # Construir contexto estructurado
     contexto = {
@@ -90,126 +329,314 @@ def buscar_programa_relevante(query: str, session) -> dict:
                 'horas': m.carga_horaria,
                 'area': m.area_tematica
             }
-            for m in materias[:30]  # Limitar a 30 para no sobrecargar
+            for m in relevantes
         ],
         'total_materias': len(materias)
     }
     
     return contexto
 
-def construir_prompt_con_contexto(pregunta: str, contexto: dict = None) -> str:
+def obtener_contexto(pregunta_normalizada: str, vector: bytes = None) -> dict:
     """
-    Construye prompt optimizado con contexto de BD
+    RAG de una pregunta normalizada. Sin cache propia: lo cachea (ya
+    serializado) obtener_programa_serializado
     """
-    
+    with get_session() as session:
+        return buscar_programa_relevante(pregunta_normalizada, session, vector)
+
+# Fijo para todas las consultas: OpenAI cachea el prefijo repetido del prompt
+SYSTEM_PROMPT = """Sos un asistente experto en los posgrados de la Facultad de Derecho de la UBA. Respondés de forma clara, precisa y estructurada.
+
+Cada mensaje del usuario es un JSON con:
+- "pregunta": la consulta del usuario
+- "programa" (opcional): datos del programa consultado, tomados de la base oficial (director, contactos, duración, carga horaria, modalidad, horario, objetivos, requisitos y las materias más relevantes del plan de estudios; "total_materias" es el total del plan)
+
+INSTRUCCIONES:
+1. Si hay "programa", respondé usando SOLO esa información
+2. Sé específico: cita carga horaria, nombres de materias, contactos
+3. Si el usuario pregunta algo que NO está en los datos, decilo claramente y sugerí contactar a la Dirección de Posgrado
+4. Formato: claro, estructurado, bullets cuando corresponda
+5. Incluí siempre el email de contacto relevante al final (el del programa, o el general de Posgrado: inscripcionesposgrado@derecho.uba.ar)"""
+
+def serializar_programa(contexto: dict) -> str:
+    """JSON compacto del programa para el prompt (objetivos y requisitos recortados)"""
+    programa = {
+        **contexto,
+        'objetivos': contexto['objetivos'][:500],
+        'requisitos': contexto['requisitos'][:500],
+        'materias': [
+            {k: v for k, v in m.items() if v}
+            for m in contexto['materias']
+        ]
+    }
+    return json.dumps(programa, ensure_ascii=False, separators=(',', ':'))
+
+@lru_cache(maxsize=1024)
+def obtener_programa_serializado(pregunta_normalizada: str, vector: bytes = None) -> tuple:
+    """
+    (nombre, JSON del programa) listo para el prompt, armado una sola vez
+    por pregunta normalizada; (None, None) si no hay contexto
+    """
+    contexto = obtener_contexto(pregunta_normalizada, vector)
     if not contexto:
+        return None, None
+    return contexto['nombre'], serializar_programa(contexto)
+
+def construir_prompt(pregunta: str, programa_json: str = None) -> str:
+    """
+    Mensaje del usuario: JSON compacto con el programa ya serializado y la pregunta
+    Las instrucciones van en SYSTEM_PROMPT
+    """
+    pregunta_json = json.dumps(pregunta, ensure_ascii=False)
+    if not programa_json:
         # Sin contexto específico - respuesta general
-        return f"""Sos un asistente especializado en los posgrados de la Facultad de Derecho de la UBA.
+        return '{"pregunta":' + pregunta_json + '}'
+    return '{"programa":' + programa_json + ',"pregunta":' + pregunta_json + '}'
 
-Pregunta del usuario: {pregunta}
+def construir_prompt_con_contexto(pregunta: str, contexto: dict = None) -> str:
+    """Construye el mensaje del usuario a partir del dict de contexto de BD"""
+    return construir_prompt(pregunta, serializar_programa(contexto) if contexto else None)
 
-Respondé de forma clara y precisa. Si no tenés información específica sobre lo que pregunta, indicalo claramente y sugiere contactar a la Dirección de Posgrado.
+# ============== MOTOR DE IA ==============
 
-Email general de Posgrado: inscripcionesposgrado@derecho.uba.ar
-"""
-    
-    # Con contexto - respuesta específica
-    materias_texto = "\n".join([
-        f"   - {m['nombre']}" + (f" ({m['horas']}hs)" if m['horas'] else "") + (f" [{m['tipo']}]" if m['tipo'] else "")
-        for m in contexto['materias'][:20]  # Top 20 materias
-    ])
-    
-    prompt = f"""Sos un asistente especializado en los posgrados de la Facultad de Derecho de la UBA.
+MODELO = "gpt-4o-mini"
 
-INFORMACIÓN DEL PROGRAMA CONSULTADO:
+# Enruta todas las consultas al mismo caché de prompts de OpenAI: el prefijo
+# (SYSTEM_PROMPT) es idéntico y se cobra como input cacheado.
+# Cambiar el sufijo si SYSTEM_PROMPT cambia de forma sustancial
+PROMPT_CACHE_KEY = "uba-posgrados-v1"
 
-**{contexto['nombre']}** ({contexto['tipo'].upper()})
+# Preguntas de dato puntual (contacto, fecha, lugar): se responden directo
+# del contexto, con un modelo que puede ser más barato y respuesta corta
+MODELO_SIMPLE = os.getenv('MODELO_SIMPLE', MODELO)
+MAX_TOKENS_SIMPLE = 200
+# Va como segundo mensaje de sistema (SYSTEM_PROMPT sigue igual y cacheado)
+INSTRUCCION_BREVE = "Respuesta breve: como máximo 80 palabras, sin secciones. Terminá igual con el email de contacto."
+PREGUNTA_SIMPLE_RX = re.compile(r'\b(c[oó]mo|d[oó]nde|cu[aá]ndo|email|mail|correo|tel[eé]fono|contacto)\b')
 
-📋 DATOS GENERALES:
-- Director: {contexto['director']}
-- Subdirector: {contexto['subdirector']}
-- Coordinador: {contexto['coordinador']}
-- Email de contacto: {contexto['email']}
-- Duración: {contexto['duracion']}
-- Carga horaria total: {contexto['carga_horaria']}
-- Modalidad: {contexto['modalidad']}
-- Horario de cursada: {contexto['horario']}
+def elegir_modelo(pregunta_normalizada: str, max_tokens: int = None) -> tuple:
+    """(modelo, max_tokens) según la complejidad de la pregunta"""
+    if len(pregunta_normalizada) < 60 and PREGUNTA_SIMPLE_RX.search(pregunta_normalizada):
+        return MODELO_SIMPLE, min(max_tokens or MAX_TOKENS_SIMPLE, MAX_TOKENS_SIMPLE)
+    return MODELO, max_tokens or 800
 
-📚 PLAN DE ESTUDIOS ({contexto['total_materias']} materias en total):
-{materias_texto}
+def tokens_cacheados(usage) -> int:
+    """Tokens de input que OpenAI sirvió desde su caché de prompts"""
+    detalles = getattr(usage, 'prompt_tokens_details', None)
+    return getattr(detalles, 'cached_tokens', None) or 0
 
-🎯 OBJETIVOS:
-{contexto['objetivos'][:500] if contexto['objetivos'] else 'No especificados'}
+async def preparar_consulta(pregunta: str, max_tokens: int = None) -> tuple:
+    """
+    RAG fuera del event loop + armado de mensajes
+    Retorna: (mensajes, programa_relacionado)
+    
+    max_tokens: con el tope corto (MAX_TOKENS_SIMPLE o menos) se pide una
+    respuesta breve, para que no se corte antes del email de contacto
+    """
+    clave = normalizar_pregunta(pregunta)
+    vector = await embedding_pregunta(clave)
+    
+    # 1. RAG - Buscar en BD (SQLite es bloqueante: va a un thread)
+    programa_relacionado, programa_json = await asyncio.to_thread(obtener_programa_serializado, clave, vector)
+    
+    # 2. Construir prompt con contexto
+    prompt = construir_prompt(pregunta, programa_json)
+    
+    mensajes = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+    if max_tokens and max_tokens <= MAX_TOKENS_SIMPLE:
+        mensajes.insert(1, {"role": "system", "content": INSTRUCCION_BREVE})
+    return mensajes, programa_relacionado
 
-✅ REQUISITOS DE ADMISIÓN:
-{contexto['requisitos'][:500] if contexto['requisitos'] else 'No especificados'}
+# Llamadas simultáneas a OpenAI (evita rate limits ante ráfagas)
+MAX_LLAMADAS_OPENAI = 8
+_semaforo_openai = asyncio.Semaphore(MAX_LLAMADAS_OPENAI)
 
----
+# Preguntas que ya se están respondiendo: clave normalizada -> Task.
+# Las repetidas esperan esa misma respuesta en vez de llamar de nuevo
+_en_vuelo = {}
 
-PREGUNTA DEL USUARIO: {pregunta}
+async def guardar_si_completa(clave: str, valor: tuple, finish_reason: str):
+    """Cachea la respuesta salvo que se haya cortado por max_tokens"""
+    if finish_reason == 'length':
+        logger.warning("Respuesta cortada por max_tokens, no se cachea: %.50s...", clave)
+        return
+    await guardar_respuesta_cacheada(clave, valor)
 
-INSTRUCCIONES:
-1. Respondé usando SOLO la información que te proporcioné arriba
-2. Sé específico: cita carga horaria, nombres de materias, contactos
-3. Si el usuario pregunta algo que NO está en los datos, decilo claramente
-4. Formato: claro, estructurado, bullets cuando corresponda
-5. Incluí siempre el email de contacto relevante al final
+async def _responder(pregunta: str, clave: str, max_tokens: int) -> tuple:
+    """RAG + llamada a OpenAI; guarda el resultado en cache"""
+    modelo, max_tokens = elegir_modelo(clave, max_tokens)
+    mensajes, programa_relacionado = await preparar_consulta(pregunta, max_tokens)
+    
+    # 3. Llamar a OpenAI
+    logger.info("Generando respuesta para: %.50s...", pregunta)
+    
+    async with _semaforo_openai:
+        response = await client.chat.completions.create(
+            model=modelo,
+            messages=mensajes,
+            max_tokens=max_tokens,
+            temperature=0.3,  # Más determinista para respuestas precisas
+            extra_body={"prompt_cache_key": PROMPT_CACHE_KEY}
+        )
+    
+    respuesta = response.choices[0].message.content
+    tokens_usados = response.usage.total_tokens
+    
+    logger.info("Respuesta generada. Tokens: %d (cacheados: %d)", tokens_usados, tokens_cacheados(response.usage))
+    
+    await guardar_si_completa(clave, (respuesta, programa_relacionado, tokens_usados), response.choices[0].finish_reason)
+    
+    return respuesta, programa_relacionado, tokens_usados
 
-Respondé ahora de forma directa y útil:"""
+async def _responder_stream(pregunta: str, clave: str, max_tokens: int, cola: asyncio.Queue) -> tuple:
+    """
+    Como _responder pero con stream: cada fragmento se pone en `cola` apenas
+    llega (None al terminar). La cola no tiene tope: el semáforo se libera al
+    terminar de leer OpenAI, no cuando el cliente termina de leer la respuesta
+    """
+    try:
+        modelo, max_tokens = elegir_modelo(clave, max_tokens)
+        mensajes, programa_relacionado = await preparar_consulta(pregunta, max_tokens)
+        
+        logger.info("Generando respuesta (stream) para: %.50s...", pregunta)
+        
+        partes = []
+        tokens_usados = 0
+        cacheados = 0
+        fin = None
+        async with _semaforo_openai:
+            stream = await client.chat.completions.create(
+                model=modelo,
+                messages=mensajes,
+                max_tokens=max_tokens,
+                temperature=0.3,
+                stream=True,
+                stream_options={"include_usage": True},
+                extra_body={"prompt_cache_key": PROMPT_CACHE_KEY}
+            )
+            
+            async for chunk in stream:
+                if chunk.usage:
+                    tokens_usados = chunk.usage.total_tokens
+                    cacheados = tokens_cacheados(chunk.usage)
+                if chunk.choices and chunk.choices[0].finish_reason:
+                    fin = chunk.choices[0].finish_reason
+                if chunk.choices and chunk.choices[0].delta.content:
+                    partes.append(chunk.choices[0].delta.content)
+                    cola.put_nowait(chunk.choices[0].delta.content)
+    finally:
+        cola.put_nowait(None)
     
-    return prompt
+    respuesta = "".join(partes)
+    
+    logger.info("Respuesta generada (stream). Tokens: %d (cacheados: %d)", tokens_usados, cacheados)
+    
+    await guardar_si_completa(clave, (respuesta, programa_relacionado, tokens_usados), fin)
+    
+    return respuesta, programa_relacionado, tokens_usados
 
-# ============== MOTOR DE IA ==============
+def _registrar_en_vuelo(clave: str, corutina) -> asyncio.Task:
+    """Lanza la respuesta de `clave` como tarea visible para las preguntas repetidas"""
+    tarea = _en_vuelo[clave] = asyncio.ensure_future(corutina)
+    tarea.add_done_callback(lambda _: _en_vuelo.pop(clave, None))
+    return tarea
 
-async def generar_respuesta(pregunta: str, max_tokens: int = 800) -> tuple:
+async def generar_respuesta(pregunta: str, max_tokens: int = None) -> tuple:
     """
     Genera respuesta usando RAG + OpenAI
     Retorna: (respuesta, programa_relacionado, tokens_usados)
+    
+    max_tokens: tope de la respuesta; por defecto lo decide elegir_modelo
     """
     
     try:
-        # 1. RAG - Buscar en BD
-        session = get_session()
-        contexto = buscar_programa_relevante(pregunta, session)
+        clave = normalizar_pregunta(pregunta)
         
-        programa_relacionado = contexto['nombre'] if contexto else None
+        cacheada = await leer_respuesta_cacheada(clave) or await respuesta_similar(clave)
+        if cacheada:
+            respuesta, programa_relacionado, _ = cacheada
+            logger.info("Respuesta desde cache para: %.50s...", pregunta)
+            return respuesta, programa_relacionado, 0
         
-        # 2. Construir prompt con contexto
-        prompt = construir_prompt_con_contexto(pregunta, contexto)
+        tarea = _en_vuelo.get(clave)
+        if tarea:
+            respuesta, programa_relacionado, _ = await asyncio.shield(tarea)
+            return respuesta, programa_relacionado, 0
         
-        # 3. Llamar a OpenAI
-        logger.info(f"Generando respuesta para: {pregunta[:50]}...")
+        # shield: si el cliente que la inició se desconecta, la tarea sigue para los demás
+        tarea = _registrar_en_vuelo(clave, _responder(pregunta, clave, max_tokens))
+        return await asyncio.shield(tarea)
         
-        response = await client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "Sos un asistente experto en posgrados de la UBA. Respondés de forma clara, precisa y estructurada."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            max_tokens=max_tokens,
-            temperature=0.3  # Más determinista para respuestas precisas
-        )
+    except Exception as e:
+        logger.error("Error generando respuesta: %s", e)
+        return f"Error al procesar tu pregunta: {str(e)}", None, 0
+
+async def generar_respuesta_stream(pregunta: str, resultado: dict, max_tokens: int = None):
+    """
+    Igual que generar_respuesta pero emite los fragmentos a medida que llegan
+    Al terminar completa `resultado` con: respuesta, programa_relacionado, tokens_usados
+    Mientras la respuesta propia se genera, resultado['tarea'] es la tarea que
+    la produce (sigue aunque se cierre el generador)
+    """
+    resultado.update(respuesta="", programa_relacionado=None, tokens_usados=0)
+    
+    try:
+        clave = normalizar_pregunta(pregunta)
         
-        respuesta = response.choices[0].message.content
-        tokens_usados = response.usage.total_tokens
+        cacheada = await leer_respuesta_cacheada(clave) or await respuesta_similar(clave)
+        if cacheada:
+            respuesta, programa_relacionado, _ = cacheada
+            logger.info("Respuesta desde cache para: %.50s...", pregunta)
+            resultado.update(respuesta=respuesta, programa_relacionado=programa_relacionado)
+            yield respuesta
+            return
         
-        logger.info(f"Respuesta generada. Tokens: {tokens_usados}")
+        # Misma pregunta en curso (por /q o /q/stream): se espera esa respuesta
+        # y se emite entera, sin otra llamada a OpenAI
+        tarea = _en_vuelo.get(clave)
+        if tarea:
+            respuesta, programa_relacionado, _ = await asyncio.shield(tarea)
+            resultado.update(respuesta=respuesta, programa_relacionado=programa_relacionado)
+            yield respuesta
+            return
         
-        return respuesta, programa_relacionado, tokens_usados
+        # La tarea lee OpenAI por su cuenta; si el cliente se desconecta, sigue
+        # para las preguntas repetidas y la cache
+        cola = asyncio.Queue()
+        tarea = resultado['tarea'] = _registrar_en_vuelo(clave, _responder_stream(pregunta, clave, max_tokens, cola))
+        while (fragmento := await cola.get()) is not None:
+            yield fragmento
+        
+        respuesta, programa_relacionado, tokens_usados = await asyncio.shield(tarea)
+        resultado.update(respuesta=respuesta, programa_relacionado=programa_relacionado, tokens_usados=tokens_usados)
+        del resultado['tarea']
         
     except Exception as e:
-        logger.error(f"Error generando respuesta: {e}")
-        return f"Error al procesar tu pregunta: {str(e)}", None, 0
+        resultado.pop('tarea', None)
+        logger.error("Error generando respuesta: %s", e)
+        error = f"Error al procesar tu pregunta: {str(e)}"
+        resultado['respuesta'] += error
+        yield error
+
+# Las preguntas de los botones de sugerencia de index.html
+PREGUNTAS_SUGERIDAS = (
+    '¿Qué maestrías hay disponibles?',
+    'Requisitos maestría en derecho penal',
+    '¿Cuánto dura la maestría en derecho tributario?',
+    'Especialización en derecho laboral',
+)
+
+async def precalentar_respuestas():
+    """Deja en cache las respuestas de PREGUNTAS_SUGERIDAS (las ya cacheadas no llaman a OpenAI)"""
+    await asyncio.gather(*(generar_respuesta(p) for p in PREGUNTAS_SUGERIDAS))
+    logger.info("Cache precalentada con %d preguntas sugeridas", len(PREGUNTAS_SUGERIDAS))
 
 # ============== BÚSQUEDA AVANZADA ==============
 
-def buscar_programas_avanzado(session, query: str, filtros: dict = None):
+def buscar_programas_avanzado(session, query: str, filtros: dict = None, campos: tuple = None):
     """
     Búsqueda avanzada con filtros
     
@@ -218,19 +645,12 @@ def buscar_programas_avanzado(session, query: str, filtros: dict = None):
         'modalidad': 'presencial',
         'area': 'penal'
     }
+    campos: columnas de Programa a cargar (por defecto todas)
     """
     
     q = session.query(Programa)
-    
-    # Búsqueda por texto
-    if query:
-        q = q.filter(
-            or_(
-                Programa.nombre.ilike(f'%{query}%'),
-                Programa.director.ilike(f'%{query}%'),
-                Programa.coordinador.ilike(f'%{query}%')
-            )
-        )
+    if campos:
+        q = q.options(load_only(*campos))
     
     # Aplicar filtros
     if filtros:
@@ -243,6 +663,10 @@ def buscar_programas_avanzado(session, query: str, filtros: dict = None):
         if filtros.get('area'):
             q = q.filter(Programa.nombre.ilike(f"%{filtros['area']}%"))
     
+    # Búsqueda por texto (índice FTS, ordenado por relevancia)
+    if query:
+        return buscar_programas_por_texto(session, query, q)
+    
     return q.all()
 
 def obtener_preguntas_frecuentes(session, limit=10):
@@ -3,20 +3,26 @@ Base de datos SQLite para Sistema de Posgrados UBA
 Schema completo con relaciones
 """
 
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, Float
+from sqlalchemy import create_engine, event, insert, inspect, text, or_, Column, Integer, String, Text, DateTime, ForeignKey, Float, Index, LargeBinary
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, selectinload
+from sqlalchemy.pool import QueuePool, StaticPool
 from datetime import datetime
+from functools import lru_cache
 import json
+import re
 
 Base = declarative_base()
 
+DB_PATH = "posgrados_uba.db"
+
 class Programa(Base):
     """Tabla principal - Maestrías, Especializaciones, Doctorado"""
     __tablename__ = 'programas'
     
     id = Column(Integer, primary_key=True)
-    tipo = Column(String(50))  # maestria, especializacion, doctorado
+    tipo = Column(String(50), index=True)  # maestria, especializacion, doctorado
     nombre = Column(String(300))
     nombre_corto = Column(String(100))  # para URLs
     url_principal = Column(String(500))
@@ -51,7 +57,7 @@ class Materia(Base):
     __tablename__ = 'materias'
     
     id = Column(Integer, primary_key=True)
-    programa_id = Column(Integer, ForeignKey('programas.id'))
+    programa_id = Column(Integer, ForeignKey('programas.id'), index=True)
     
     nombre = Column(String(300))
     tipo = Column(String(50))  # troncal, optativa, seminario
@@ -63,14 +69,26 @@ class Materia(Base):
     # Relación
     programa = relationship("Programa", back_populates="materias")
 
+class EmbeddingPrograma(Base):
+    """Embedding de cada programa para la búsqueda semántica del RAG"""
+    __tablename__ = 'embeddings_programas'
+    
+    programa_id = Column(Integer, ForeignKey('programas.id'), primary_key=True)
+    modelo = Column(String(100))
+    vector = Column(LargeBinary)  # float32 normalizado
+    fecha = Column(DateTime, default=datetime.now)
+
 class Consulta(Base):
     """Registro de consultas del chatbot para analytics"""
     __tablename__ = 'consultas'
+    __table_args__ = (
+        Index('ix_consultas_programa_ts', 'programa_relacionado', 'timestamp'),
+    )
     
     id = Column(Integer, primary_key=True)
-    pregunta = Column(Text)
+    pregunta = Column(Text, index=True)
     respuesta = Column(Text)
-    programa_relacionado = Column(String(200))  # nombre del programa si aplica
+    programa_relacionado = Column(String(200), index=True)  # nombre del programa si aplica
     timestamp = Column(DateTime, default=datetime.now)
     tiempo_respuesta_ms = Column(Integer)  # milisegundos
     tokens_usados = Column(Integer)
@@ -81,25 +99,142 @@ class CacheScraping(Base):
     
     id = Column(Integer, primary_key=True)
     url = Column(String(500), unique=True)
-    contenido_html = Column(Text)
-    hash_contenido = Column(String(64))  # SHA256
+    contenido_html = Column(LargeBinary)  # HTML comprimido con zstd
+    hash_contenido = Column(String(64), index=True)  # xxh3_128 del HTML
     fecha_scraping = Column(DateTime, default=datetime.now)
     status_code = Column(Integer)
+    etag = Column(String(200))  # validadores HTTP para pedir la página condicionalmente
+    last_modified = Column(String(100))
 
 # ============== FUNCIONES HELPER ==============
 
-def init_database(db_path="posgrados_uba.db"):
+# Carga las materias del programa en una sola query, sin la descripción (no se usa)
+CARGAR_MATERIAS = selectinload(Programa.materias).load_only(
+    Materia.programa_id,
+    Materia.nombre,
+    Materia.tipo,
+    Materia.carga_horaria,
+    Materia.area_tematica
+)
+
+def _configurar_sqlite(dbapi_connection, connection_record):
+    """
+    PRAGMAs por conexión: WAL para que las escrituras no bloqueen lecturas,
+    y la BD (chica, casi solo lectura) mapeada en memoria
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256 MB
+    cursor.execute("PRAGMA cache_size=-65536")  # 64 MB
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+@lru_cache(maxsize=None)
+def get_engine(db_path=DB_PATH):
+    """
+    Engine único por archivo de BD (se reutiliza el pool de conexiones)
+    
+    En disco: QueuePool, una conexión por worker para que con WAL las
+    lecturas corran en paralelo; timeout espera al escritor en vez de
+    fallar con "database is locked". En memoria: una sola conexión compartida.
+    """
+    connect_args = {'check_same_thread': False, 'timeout': 15}
+    if db_path == ':memory:':
+        pool = {'poolclass': StaticPool}
+    else:
+        pool = {'poolclass': QueuePool, 'pool_size': 10, 'max_overflow': 20}
+    
+    engine = create_engine(
+        f'sqlite:///{db_path}',
+        connect_args=connect_args,
+        pool_pre_ping=True,
+        **pool
+    )
+    event.listen(engine, "connect", _configurar_sqlite)
+    return engine
+
+@lru_cache(maxsize=None)
+def get_session_factory(db_path=DB_PATH):
+    """Fábrica de sesiones asociada al engine cacheado"""
+    return sessionmaker(bind=get_engine(db_path), expire_on_commit=False)
+
+_engine = get_engine()
+SessionLocal = get_session_factory()
+
+# Índice full-text sobre programas, sincronizado por triggers
+FTS_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS programas_fts USING fts5(
+        nombre, director, coordinador,
+        content='programas', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS programas_fts_ai AFTER INSERT ON programas BEGIN
+        INSERT INTO programas_fts(rowid, nombre, director, coordinador)
+        VALUES (new.id, new.nombre, new.director, new.coordinador);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS programas_fts_ad AFTER DELETE ON programas BEGIN
+        INSERT INTO programas_fts(programas_fts, rowid, nombre, director, coordinador)
+        VALUES ('delete', old.id, old.nombre, old.director, old.coordinador);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS programas_fts_au AFTER UPDATE ON programas BEGIN
+        INSERT INTO programas_fts(programas_fts, rowid, nombre, director, coordinador)
+        VALUES ('delete', old.id, old.nombre, old.director, old.coordinador);
+        INSERT INTO programas_fts(rowid, nombre, director, coordinador)
+        VALUES (new.id, new.nombre, new.director, new.coordinador);
+    END""",
+]
+
+def crear_indice_fts(engine):
+    """Crea el índice FTS5 y sus triggers; si es nuevo lo llena con los programas existentes"""
+    with engine.begin() as conn:
+        existia = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE name = 'programas_fts'"
+        ).first()
+        for sql in FTS_SCHEMA:
+            conn.exec_driver_sql(sql)
+        if not existia:
+            conn.exec_driver_sql("INSERT INTO programas_fts(programas_fts) VALUES ('rebuild')")
+
+def crear_indices(engine):
+    """Crea los índices faltantes en tablas ya existentes (create_all solo los crea con la tabla)"""
+    for tabla in Base.metadata.sorted_tables:
+        for indice in tabla.indexes:
+            indice.create(engine, checkfirst=True)
+
+def crear_columnas_faltantes(engine):
+    """Agrega a tablas ya existentes las columnas nuevas del modelo (create_all no las agrega)"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for tabla in Base.metadata.sorted_tables:
+            if not inspector.has_table(tabla.name):
+                continue
+            existentes = {c['name'] for c in inspector.get_columns(tabla.name)}
+            for columna in tabla.columns:
+                if columna.name not in existentes:
+                    tipo = columna.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {tabla.name} ADD COLUMN "{columna.name}" {tipo}'))
+
+def init_database(db_path=DB_PATH):
     """Inicializa la base de datos"""
-    engine = create_engine(f'sqlite:///{db_path}')
+    engine = get_engine(db_path)
     Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-    return engine, Session()
+    crear_columnas_faltantes(engine)
+    crear_indices(engine)
+    crear_indice_fts(engine)
+    return engine, get_session_factory(db_path)()
 
-def get_session(db_path="posgrados_uba.db"):
+def get_session(db_path=DB_PATH):
     """Obtiene una sesión de BD"""
-    engine = create_engine(f'sqlite:///{db_path}')
-    Session = sessionmaker(bind=engine)
-    return Session()
+    return get_session_factory(db_path)()
+
+def get_db():
+    """Dependencia de FastAPI: una sesión por request, cerrada al terminar"""
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
 
 def agregar_programa(session, datos):
     """
@@ -134,18 +269,92 @@ def agregar_materia(session, programa_id, datos):
     session.commit()
     return materia.id
 
-def registrar_consulta(session, pregunta, respuesta, programa=None, tiempo_ms=0, tokens=0):
-    """Registra una consulta del usuario"""
-    consulta = Consulta(
+def agregar_materias(session, programa_id, materias):
+    """
+    Agrega todas las materias de un programa en un solo INSERT
+    (executemany) y una sola transacción
+    
+    materias = [{'nombre': ..., 'tipo': ..., 'carga_horaria': ...}, ...]
+    """
+    if materias:
+        session.execute(insert(Materia), [{**datos, 'programa_id': programa_id} for datos in materias])
+    session.commit()
+
+def _nueva_consulta(pregunta, respuesta, programa=None, tiempo_ms=0, tokens=0):
+    return Consulta(
         pregunta=pregunta,
         respuesta=respuesta,
         programa_relacionado=programa,
         tiempo_respuesta_ms=tiempo_ms,
         tokens_usados=tokens
     )
-    session.add(consulta)
+
+def registrar_consulta(session, pregunta, respuesta, programa=None, tiempo_ms=0, tokens=0):
+    """Registra una consulta del usuario"""
+    session.add(_nueva_consulta(pregunta, respuesta, programa, tiempo_ms, tokens))
     session.commit()
 
+def registrar_consultas(session, consultas):
+    """
+    Registra varias consultas en una sola transacción
+    
+    consultas = [{'pregunta': ..., 'respuesta': ..., 'programa': ..., 'tiempo_ms': ..., 'tokens': ...}]
+    """
+    session.add_all([_nueva_consulta(**datos) for datos in consultas])
+    session.commit()
+
+_PALABRAS = re.compile(r'\w+')
+
+def buscar_ids_fts(session, query, limit=None):
+    """
+    Ids de programas cuyo nombre/director/coordinador contienen todas las
+    palabras de `query` (por prefijo), ordenados por relevancia
+    Retorna None si el índice FTS no existe
+    """
+    palabras = _PALABRAS.findall(query)
+    if not palabras:
+        return []
+    
+    match = ' '.join(f'"{p}"*' for p in palabras)
+    sql = "SELECT rowid FROM programas_fts WHERE programas_fts MATCH :match ORDER BY rank"
+    params = {'match': match}
+    if limit:
+        sql += " LIMIT :limit"
+        params['limit'] = limit
+    
+    try:
+        return [row[0] for row in session.execute(text(sql), params)]
+    except OperationalError:
+        session.rollback()
+        return None
+
+def buscar_programas_por_texto(session, query, q=None, limit=None):
+    """
+    Programas que matchean `query`, del más al menos relevante
+    
+    q: query base con filtros adicionales (por defecto todos los programas)
+    Si no hay índice FTS cae a ILIKE sobre nombre, director y coordinador
+    """
+    if q is None:
+        q = session.query(Programa)
+    
+    ids = buscar_ids_fts(session, query, limit)
+    
+    if ids is None:
+        q = q.filter(or_(
+            Programa.nombre.ilike(f'%{query}%'),
+            Programa.director.ilike(f'%{query}%'),
+            Programa.coordinador.ilike(f'%{query}%')
+        ))
+        return q.limit(limit).all() if limit else q.all()
+    
+    if not ids:
+        return []
+    
+    orden = {programa_id: i for i, programa_id in enumerate(ids)}
+    programas = q.filter(Programa.id.in_(ids)).all()
+    return sorted(programas, key=lambda p: orden[p.id])
+
 def buscar_programas(session, query, tipo=None):
     """
     Búsqueda fuzzy de programas
@@ -158,14 +367,8 @@ def buscar_programas(session, query, tipo=None):
     if tipo:
         q = q.filter(Programa.tipo == tipo)
     
-    # Búsqueda en nombre, director, área
-    q = q.filter(
-        (Programa.nombre.like(f'%{query}%')) |
-        (Programa.director.like(f'%{query}%')) |
-        (Programa.coordinador.like(f'%{query}%'))
-    )
-    
-    return q.all()
+    # Búsqueda en nombre, director, coordinador
+    return buscar_programas_por_texto(session, query, q)
 
 def get_stats(session):
     """Obtiene estadísticas generales"""
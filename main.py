@@ -5,23 +5,32 @@ FastAPI + SQLite + OpenAI + RAG
 
 import os
 import time
+import asyncio
+import gzip
+import threading
 import logging
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+import msgspec
+import orjson
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Request, Depends
+from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+from sqlalchemy.orm import Session, joinedload, load_only
 from contextlib import asynccontextmanager
 
 # Imports locales
 from database import (
     get_session, 
+    get_db,
     get_stats, 
     get_programas_mas_consultados,
-    registrar_consulta,
+    registrar_consultas,
+    CARGAR_MATERIAS,
     Programa,
     Materia
 )
-from ai_engine import generar_respuesta, buscar_programas_avanzado
+from ai_engine import client, cache_redis, generar_respuesta, generar_respuesta_stream, buscar_programas_avanzado, precalentar_respuestas
 
 # ============== CONFIGURACIÓN ==============
 
@@ -36,6 +45,51 @@ if not os.getenv('OPENAI_API_KEY'):
     logger.error("⚠️  OPENAI_API_KEY no configurada")
     raise ValueError("OPENAI_API_KEY requerida")
 
+# ============== ANALYTICS ==============
+
+# Consultas pendientes de registrar: se escriben en lote, fuera del request
+CONSULTAS_PENDIENTES: asyncio.Queue = asyncio.Queue()
+LOTE_MAXIMO = 100
+
+def guardar_lote(lote):
+    """Escribe un lote de consultas en una sola transacción"""
+    with get_session() as session:
+        registrar_consultas(session, lote)
+
+async def escribir_consultas():
+    """Tarea de fondo: vacía la cola en lotes de hasta LOTE_MAXIMO"""
+    while True:
+        lote = [await CONSULTAS_PENDIENTES.get()]
+        while len(lote) < LOTE_MAXIMO and not CONSULTAS_PENDIENTES.empty():
+            lote.append(CONSULTAS_PENDIENTES.get_nowait())
+        
+        try:
+            await asyncio.to_thread(guardar_lote, lote)
+        except Exception as e:
+            logger.error("Error registrando %d consultas: %s", len(lote), e)
+        
+        await asyncio.sleep(0.05)
+
+def encolar_consulta(**datos):
+    """Agenda el registro de una consulta (mismos argumentos que registrar_consulta)"""
+    CONSULTAS_PENDIENTES.put_nowait(datos)
+
+def registrar_consulta_terminada(pregunta: str, tarea: asyncio.Task, inicio: float):
+    """Registra una consulta de /q/stream cuyo cliente se fue antes del final"""
+    if tarea.cancelled():
+        return
+    if tarea.exception():
+        respuesta, programa, tokens = f"Error al procesar tu pregunta: {tarea.exception()}", None, 0
+    else:
+        respuesta, programa, tokens = tarea.result()
+    encolar_consulta(
+        pregunta=pregunta,
+        respuesta=respuesta,
+        programa=programa,
+        tiempo_ms=int((time.time() - inicio) * 1000),
+        tokens=tokens
+    )
+
 # ============== LIFESPAN ==============
 
 @asynccontextmanager
@@ -47,39 +101,170 @@ async def lifespan(app: FastAPI):
     if not os.path.exists('posgrados_uba.db'):
         logger.warning("⚠️  Base de datos no encontrada. Ejecutá scraper_complete.py primero.")
     else:
-        session = get_session()
-        stats = get_stats(session)
+        with get_session() as session:
+            stats = get_stats(session)
         logger.info(f"✅ BD cargada: {stats['total_programas']} programas, {stats['total_materias']} materias")
     
+    escritor = asyncio.create_task(escribir_consultas())
+    
+    # Respuestas de los botones de sugerencia, en segundo plano para no demorar el arranque
+    calentamiento = None
+    if os.path.exists('posgrados_uba.db') and os.getenv('OPENAI_API_KEY'):
+        calentamiento = asyncio.create_task(precalentar_respuestas())
+    
     yield
     
     logger.info("👋 Cerrando servidor...")
+    
+    if calentamiento:
+        calentamiento.cancel()
+    
+    # Guardar lo que haya quedado en la cola
+    escritor.cancel()
+    pendientes = []
+    while not CONSULTAS_PENDIENTES.empty():
+        pendientes.append(CONSULTAS_PENDIENTES.get_nowait())
+    if pendientes:
+        guardar_lote(pendientes)
+    
+    await client.close()
+    if cache_redis:
+        await cache_redis.aclose()
 
 app = FastAPI(
     title="Posgrados UBA Derecho",
     description="Sistema de consultas con IA",
     version="2.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
-# ============== MODELS ==============
+# JSON ya serializado de los endpoints de catálogo (solo cambian al re-scrapear)
+CATALOGO_CACHE = TTLCache(maxsize=512, ttl=300)
+# Los endpoints son `def` (corren en el threadpool) y TTLCache no es thread-safe
+_catalogo_lock = threading.Lock()
+
+def json_cacheado(clave):
+    """Respuesta JSON desde CATALOGO_CACHE, o None si no está"""
+    with _catalogo_lock:
+        body = CATALOGO_CACHE.get(clave)
+    return Response(body, media_type="application/json") if body is not None else None
 
-class Pregunta(BaseModel):
-    pregunta: str
+def cachear_json(clave, datos):
+    """Serializa `datos` una vez, lo guarda en CATALOGO_CACHE y lo devuelve"""
+    body = msgspec.json.encode(datos)
+    with _catalogo_lock:
+        CATALOGO_CACHE[clave] = body
+    return Response(body, media_type="application/json")
+
+# ============== MODELS ==============
 
 class BusquedaAvanzada(BaseModel):
     query: str
     tipo: str | None = None
     modalidad: str | None = None
 
+# Respuestas de los endpoints de catálogo: msgspec las serializa sin pasar por dicts
+
+class ProgramaResumen(msgspec.Struct):
+    id: int
+    tipo: str | None
+    nombre: str | None
+    director: str | None
+    email: str | None
+    duracion: float | None
+    carga_horaria: int | None
+    modalidad: str | None
+
+class ProgramaDetalle(msgspec.Struct):
+    id: int
+    tipo: str | None
+    nombre: str | None
+    director: str | None
+    subdirector: str | None
+    coordinador: str | None
+    email: str | None
+    duracion: float | None
+    carga_horaria: int | None
+    modalidad: str | None
+    horario: str | None
+    objetivos: str | None
+    requisitos: str | None
+
+class MateriaPlan(msgspec.Struct):
+    nombre: str | None
+    tipo: str | None
+    horas: int | None
+    area: str | None
+
+class DetallePrograma(msgspec.Struct):
+    programa: ProgramaDetalle
+    materias: list[MateriaPlan]
+    total_materias: int
+
+class MateriaEncontrada(msgspec.Struct):
+    nombre: str | None
+    programa: str | None
+    tipo: str | None
+    horas: int | None
+
+class ProgramaConsultado(msgspec.Struct):
+    programa: str
+    consultas: int
+
+class Estadisticas(msgspec.Struct):
+    general: dict[str, int]
+    programas_mas_consultados: list[ProgramaConsultado]
+
+def respuesta_msgspec(datos) -> Response:
+    return Response(msgspec.json.encode(datos), media_type="application/json")
+
 # ============== ENDPOINTS ==============
 
+# HTML estático en memoria: archivo -> (mtime, contenido, contenido_gzip, etag)
+_PAGINAS = {}
+
+def etag_coincide(if_none_match: str | None, etag: str) -> bool:
+    """True si If-None-Match (uno o varios ETags, fuertes o débiles, o *) incluye `etag`"""
+    if not if_none_match:
+        return False
+    candidatos = [e.strip().removeprefix('W/') for e in if_none_match.split(',')]
+    return '*' in candidatos or etag in candidatos
+
+def servir_pagina(archivo: str, request: Request) -> Response:
+    """
+    Sirve un HTML desde memoria (se relee solo si cambió el mtime)
+    Con ETag: si el navegador ya lo tiene responde 304 sin cuerpo
+    Si el cliente acepta gzip se manda la versión ya comprimida
+    """
+    mtime = os.stat(archivo).st_mtime_ns
+    cacheada = _PAGINAS.get(archivo)
+    if not cacheada or cacheada[0] != mtime:
+        with open(archivo, 'rb') as f:
+            contenido = f.read()
+        cacheada = _PAGINAS[archivo] = (
+            mtime, contenido, gzip.compress(contenido, 6), f'"{mtime:x}-{len(contenido):x}"'
+        )
+    
+    _, contenido, contenido_gzip, etag = cacheada
+    
+    # Cada representación tiene su ETag: un 304 validado con el de la versión
+    # gzip no le sirve a un cliente sin gzip (ni al revés)
+    usar_gzip = 'gzip' in request.headers.get('accept-encoding', '')
+    if usar_gzip:
+        etag = etag[:-1] + '-gz"'
+    headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+    if etag_coincide(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+    if usar_gzip:
+        return HTMLResponse(contenido_gzip, headers={**headers, "Content-Encoding": "gzip"})
+    return HTMLResponse(contenido, headers=headers)
+
 @app.get("/", response_class=HTMLResponse)
-async def root():
+async def root(request: Request):
     """Sirve index.html"""
     try:
-        with open('index.html', 'r', encoding='utf-8') as f:
-            return f.read()
+        return servir_pagina('index.html', request)
     except FileNotFoundError:
         return HTMLResponse("""
             <html>
@@ -91,18 +276,16 @@ async def root():
         """)
 
 @app.get("/dashboard.html", response_class=HTMLResponse)
-async def dashboard():
+async def dashboard(request: Request):
     """Sirve dashboard.html"""
     try:
-        with open('dashboard.html', 'r', encoding='utf-8') as f:
-            return f.read()
+        return servir_pagina('dashboard.html', request)
     except FileNotFoundError:
         return HTMLResponse("<h1>Dashboard no disponible</h1>")
 
 @app.get("/health")
-async def health():
+def health(session: Session = Depends(get_db)):
     """Health check"""
-    session = get_session()
     stats = get_stats(session)
     
     return {
@@ -112,36 +295,49 @@ async def health():
         "materias": stats['total_materias']
     }
 
+async def leer_pregunta(request: Request) -> str:
+    """
+    Lee {"pregunta": "..."} del body. Es un solo campo: se valida a mano
+    en vez de instanciar un modelo de pydantic por request
+    """
+    try:
+        body = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="JSON inválido")
+    
+    pregunta = body.get('pregunta') if isinstance(body, dict) else None
+    if not isinstance(pregunta, str) or len(pregunta.strip()) < 3:
+        raise HTTPException(status_code=400, detail="Pregunta muy corta")
+    return pregunta
+
 @app.post("/q")
-async def consultar(pregunta: Pregunta, request: Request):
+async def consultar(request: Request):
     """
     Endpoint principal - Consulta con IA + RAG
+    Body: {"pregunta": "..."}
     """
     inicio = time.time()
     
-    if not pregunta.pregunta or len(pregunta.pregunta.strip()) < 3:
-        raise HTTPException(status_code=400, detail="Pregunta muy corta")
+    pregunta = await leer_pregunta(request)
     
     try:
         # Generar respuesta usando RAG + OpenAI
         respuesta, programa_relacionado, tokens = await generar_respuesta(
-            pregunta.pregunta
+            pregunta
         )
         
         tiempo_ms = int((time.time() - inicio) * 1000)
         
-        # Registrar consulta para analytics
-        session = get_session()
-        registrar_consulta(
-            session,
-            pregunta=pregunta.pregunta,
+        # Registrar consulta para analytics (sin demorar la respuesta)
+        encolar_consulta(
+            pregunta=pregunta,
             respuesta=respuesta,
             programa=programa_relacionado,
             tiempo_ms=tiempo_ms,
             tokens=tokens
         )
         
-        logger.info(f"Consulta procesada en {tiempo_ms}ms - {tokens} tokens")
+        logger.info("Consulta procesada en %dms - %d tokens", tiempo_ms, tokens)
         
         return {
             "respuesta": respuesta,
@@ -150,95 +346,153 @@ async def consultar(pregunta: Pregunta, request: Request):
         }
         
     except Exception as e:
-        logger.error(f"Error procesando consulta: {e}")
+        logger.error("Error procesando consulta: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/q/stream")
+async def consultar_stream(request: Request):
+    """
+    Igual que /q pero con la respuesta en streaming (Server-Sent Events)
+    Eventos: {"delta": "..."} por fragmento y {"fin": true, ...} al terminar
+    """
+    inicio = time.time()
+    
+    pregunta = await leer_pregunta(request)
+    
+    resultado = {}
+    
+    async def eventos():
+        try:
+            async for fragmento in generar_respuesta_stream(pregunta, resultado):
+                yield b"data: " + orjson.dumps({'delta': fragmento}) + b"\n\n"
+            
+            resultado['tiempo_ms'] = int((time.time() - inicio) * 1000)
+            fin = {
+                "fin": True,
+                "programa_relacionado": resultado['programa_relacionado'],
+                "tiempo_ms": resultado['tiempo_ms']
+            }
+            yield b"data: " + orjson.dumps(fin) + b"\n\n"
+            
+            logger.info("Consulta (stream) procesada en %dms - %d tokens", resultado['tiempo_ms'], resultado['tokens_usados'])
+        finally:
+            # Se registra aunque el cliente se desconecte a mitad del stream
+            tarea = resultado.get('tarea')
+            if tarea is not None:
+                # La respuesta se sigue generando: se registra cuando termine
+                tarea.add_done_callback(lambda t: registrar_consulta_terminada(pregunta, t, inicio))
+            elif resultado.get('respuesta'):
+                encolar_consulta(
+                    pregunta=pregunta,
+                    respuesta=resultado['respuesta'],
+                    programa=resultado['programa_relacionado'],
+                    tiempo_ms=resultado.get('tiempo_ms', int((time.time() - inicio) * 1000)),
+                    tokens=resultado['tokens_usados']
+                )
+    
+    return StreamingResponse(eventos(), media_type="text/event-stream")
+
 @app.get("/api/programas")
-async def listar_programas(tipo: str | None = None, limit: int = 50):
+def listar_programas(tipo: str | None = None, limit: int = 50, session: Session = Depends(get_db)):
     """
     Lista todos los programas
     Query params: ?tipo=maestria&limit=20
     """
-    session = get_session()
+    clave = ('programas', tipo, limit)
+    if cacheada := json_cacheado(clave):
+        return cacheada
     
-    query = session.query(Programa)
+    # Solo las columnas que se devuelven (no los Text largos como objetivos)
+    query = session.query(
+        Programa.id,
+        Programa.tipo,
+        Programa.nombre,
+        Programa.director,
+        Programa.email,
+        Programa.duracion_años,
+        Programa.carga_horaria_total,
+        Programa.modalidad
+    )
     
     if tipo:
         query = query.filter(Programa.tipo == tipo)
     
     programas = query.limit(limit).all()
     
-    return [
-        {
-            "id": p.id,
-            "tipo": p.tipo,
-            "nombre": p.nombre,
-            "director": p.director,
-            "email": p.email,
-            "duracion": p.duracion_años,
-            "carga_horaria": p.carga_horaria_total,
-            "modalidad": p.modalidad
-        }
+    return cachear_json(clave, [
+        ProgramaResumen(
+            id=p.id,
+            tipo=p.tipo,
+            nombre=p.nombre,
+            director=p.director,
+            email=p.email,
+            duracion=p.duracion_años,
+            carga_horaria=p.carga_horaria_total,
+            modalidad=p.modalidad
+        )
         for p in programas
-    ]
+    ])
 
 @app.get("/api/programas/{programa_id}")
-async def detalle_programa(programa_id: int):
+def detalle_programa(programa_id: int, session: Session = Depends(get_db)):
     """
     Detalle completo de un programa con materias
     """
-    session = get_session()
+    clave = ('programa', programa_id)
+    if cacheada := json_cacheado(clave):
+        return cacheada
     
-    programa = session.query(Programa).filter_by(id=programa_id).first()
+    programa = session.query(Programa).options(CARGAR_MATERIAS).filter_by(id=programa_id).first()
     
     if not programa:
         raise HTTPException(status_code=404, detail="Programa no encontrado")
     
-    materias = session.query(Materia).filter_by(programa_id=programa_id).all()
+    materias = programa.materias
     
-    return {
-        "programa": {
-            "id": programa.id,
-            "tipo": programa.tipo,
-            "nombre": programa.nombre,
-            "director": programa.director,
-            "subdirector": programa.subdirector,
-            "coordinador": programa.coordinador,
-            "email": programa.email,
-            "duracion": programa.duracion_años,
-            "carga_horaria": programa.carga_horaria_total,
-            "modalidad": programa.modalidad,
-            "horario": programa.horario_cursada,
-            "objetivos": programa.objetivos,
-            "requisitos": programa.requisitos
-        },
-        "materias": [
-            {
-                "nombre": m.nombre,
-                "tipo": m.tipo,
-                "horas": m.carga_horaria,
-                "area": m.area_tematica
-            }
+    return cachear_json(clave, DetallePrograma(
+        programa=ProgramaDetalle(
+            id=programa.id,
+            tipo=programa.tipo,
+            nombre=programa.nombre,
+            director=programa.director,
+            subdirector=programa.subdirector,
+            coordinador=programa.coordinador,
+            email=programa.email,
+            duracion=programa.duracion_años,
+            carga_horaria=programa.carga_horaria_total,
+            modalidad=programa.modalidad,
+            horario=programa.horario_cursada,
+            objetivos=programa.objetivos,
+            requisitos=programa.requisitos
+        ),
+        materias=[
+            MateriaPlan(
+                nombre=m.nombre,
+                tipo=m.tipo,
+                horas=m.carga_horaria,
+                area=m.area_tematica
+            )
             for m in materias
         ],
-        "total_materias": len(materias)
-    }
+        total_materias=len(materias)
+    ))
 
 @app.post("/api/buscar")
-async def buscar(busqueda: BusquedaAvanzada):
+def buscar(busqueda: BusquedaAvanzada, session: Session = Depends(get_db)):
     """
     Búsqueda avanzada de programas
     Body: {"query": "penal", "tipo": "maestria", "modalidad": "presencial"}
     """
-    session = get_session()
-    
     filtros = {}
     if busqueda.tipo:
         filtros['tipo'] = busqueda.tipo
     if busqueda.modalidad:
         filtros['modalidad'] = busqueda.modalidad
     
-    resultados = buscar_programas_avanzado(session, busqueda.query, filtros)
+    resultados = buscar_programas_avanzado(
+        session, busqueda.query, filtros,
+        campos=(Programa.id, Programa.tipo, Programa.nombre, Programa.director, Programa.email)
+    )
     
     return [
         {
@@ -252,57 +506,56 @@ async def buscar(busqueda: BusquedaAvanzada):
     ]
 
 @app.get("/api/estadisticas")
-async def estadisticas():
+def estadisticas(session: Session = Depends(get_db)):
     """
     Estadísticas generales del sistema
     """
-    session = get_session()
-    
     stats = get_stats(session)
     top_programas = get_programas_mas_consultados(session, limit=10)
     
-    return {
-        "general": stats,
-        "programas_mas_consultados": [
-            {"programa": p[0], "consultas": p[1]}
+    return respuesta_msgspec(Estadisticas(
+        general=stats,
+        programas_mas_consultados=[
+            ProgramaConsultado(programa=p[0], consultas=p[1])
             for p in top_programas
         ]
-    }
+    ))
 
 @app.get("/api/materias")
-async def buscar_materias(q: str, limit: int = 20):
+def buscar_materias(q: str, limit: int = 20, session: Session = Depends(get_db)):
     """
     Búsqueda de materias por nombre
     """
-    session = get_session()
-    
-    materias = session.query(Materia).filter(
+    materias = session.query(Materia).options(
+        load_only(Materia.nombre, Materia.tipo, Materia.carga_horaria),
+        joinedload(Materia.programa).load_only(Programa.nombre)
+    ).filter(
         Materia.nombre.ilike(f'%{q}%')
     ).limit(limit).all()
     
-    return [
-        {
-            "nombre": m.nombre,
-            "programa": m.programa.nombre,
-            "tipo": m.tipo,
-            "horas": m.carga_horaria
-        }
+    return respuesta_msgspec([
+        MateriaEncontrada(
+            nombre=m.nombre,
+            programa=m.programa.nombre,
+            tipo=m.tipo,
+            horas=m.carga_horaria
+        )
         for m in materias
-    ]
+    ])
 
 # ============== ERROR HANDLERS ==============
 
 @app.exception_handler(404)
 async def not_found_handler(request: Request, exc: HTTPException):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=404,
         content={"error": "Recurso no encontrado"}
     )
 
 @app.exception_handler(500)
 async def internal_error_handler(request: Request, exc: Exception):
-    logger.error(f"Error interno: {exc}")
-    return JSONResponse(
+    logger.error("Error interno: %s", exc)
+    return ORJSONResponse(
         status_code=500,
         content={"error": "Error interno del servidor"}
     )
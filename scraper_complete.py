@@ -3,19 +3,71 @@ Scraper Exhaustivo de Posgrados UBA Derecho
 Extrae el 100% de información disponible
 """
 
+import os
+import sys
 import asyncio
 import aiohttp
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 import re
-import json
-import hashlib
-from datetime import datetime
-from database import init_database, agregar_programa, agregar_materia, CacheScraping
+import orjson
+import time
+import random
+import xxhash
+import zstandard
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from sqlalchemy import func
+from database import init_database, agregar_programa, agregar_materias, CacheScraping, Programa, EmbeddingPrograma
 
 # ============== CONFIGURACIÓN ==============
 
 BASE_URL = "https://www.derecho.uba.ar/academica/posgrados"
 
+# Requests simultáneos al sitio (las 4 páginas de un programa van en paralelo)
+MAX_CONCURRENCIA = 4
+_semaforo = asyncio.Semaphore(MAX_CONCURRENCIA)
+
+# Datos con menos de estas horas no se vuelven a scrapear al arrancar
+# (cada deploy/restart de Railway corre el scraper antes del servidor)
+SCRAPE_TTL_HORAS = float(os.getenv('SCRAPE_TTL_HORAS', '24'))
+
+# Programas en curso a la vez: acota los resultados parseados en memoria y
+# hace que los programas terminen de a uno en vez de todos al final
+MAX_PROGRAMAS_SIMULTANEOS = 8
+
+# Páginas verificadas hace menos de estas horas se leen de CacheScraping
+# sin pedirlas (p. ej. si una corrida cortada se reintenta enseguida); las
+# demás se revalidan con ETag / Last-Modified, que si no cambiaron es un 304.
+# Nunca supera SCRAPE_TTL_HORAS: una corrida habilitada por datos viejos tiene
+# que consultar el sitio, no recargar el HTML de la anterior. 0 = siempre pedir
+CACHE_PAGINAS_HORAS = min(float(os.getenv('CACHE_PAGINAS_HORAS', '6')), SCRAPE_TTL_HORAS)
+
+# Pedidos por segundo al sitio, compartido por todos los programas en curso
+PEDIDOS_POR_SEGUNDO = float(os.getenv('PEDIDOS_POR_SEGUNDO', '8'))
+
+# Intentos por página ante errores de red, 429 o 5xx
+MAX_INTENTOS = 3
+
+# Espera máxima aceptada de un Retry-After (segundos)
+MAX_RETRY_AFTER = 60
+
+# Tope de bytes leídos por página: lo que sigue (footer, sidebars) no se parsea
+MAX_BYTES_PAGINA = 512_000
+
+# Páginas descargadas en esta corrida (url -> (html, status, etag, last_modified)), para CacheScraping
+_paginas_descargadas = {}
+_compresor = zstandard.ZstdCompressor(level=6)
+_descompresor = zstandard.ZstdDecompressor()
+
+# De corridas anteriores (url -> (etag, last_modified, html, vigente)).
+# Las vigentes se usan sin ir a la red; del resto se piden con los
+# validadores, y si el sitio responde 304 se reutiliza el HTML guardado
+_paginas_guardadas = {}
+
+# Sesión HTTP del proceso: se crea al primer uso y se reutiliza entre
+# corridas (mantiene el pool de conexiones y la cache de DNS)
+_sesion = None
+
 MAESTRIAS_LIST = [
     'mae_bases_culturales_de_los_derechos_fundamentales',
     'mae_der_adm_y_adm_publica',
@@ -67,47 +119,239 @@ ESPECIALIZACIONES_LIST = [
     'carr_esp_sistemas_procesales_orales'
 ]
 
+# Tabla única (nombre_corto, tipo) que recorre el scraper
+PROGRAMAS = (
+    [(nombre, 'maestria') for nombre in MAESTRIAS_LIST] +
+    [(nombre, 'especializacion') for nombre in ESPECIALIZACIONES_LIST]
+)
+
 # ============== UTILIDADES ==============
 
+def obtener_sesion():
+    """Sesión aiohttp compartida (el límite por host la hace amable con el sitio)"""
+    global _sesion
+    if _sesion is None or _sesion.closed:
+        _sesion = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=32,
+                limit_per_host=MAX_CONCURRENCIA,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+                enable_cleanup_closed=True  # libera los sockets TLS que el server deja a medio cerrar
+            ),
+            timeout=aiohttp.ClientTimeout(total=15),
+            headers={
+                'User-Agent': 'Mozilla/5.0 (compatible; UBA-Posgrados-Bot)',
+                'Accept-Encoding': 'gzip, deflate'
+            }
+        )
+    return _sesion
+
+async def cerrar_sesion():
+    """Cierra la sesión compartida, si existe"""
+    global _sesion
+    if _sesion is not None:
+        await _sesion.close()
+        _sesion = None
+
+# Regexes de los parsers, compiladas una sola vez
+_ESPACIOS = re.compile(r'\s+')
+# Primera línea de más de 100 caracteres (sin partir el texto en una lista)
+_PARRAFO_LARGO = re.compile(r'^[^\n]{101,}', re.MULTILINE)
+_HORAS = re.compile(r'(\d+)\s*horas?', re.IGNORECASE)
+_AÑOS = re.compile(r'(\d+(?:\.\d+)?)\s*años?', re.IGNORECASE)
+# Director, subdirector y coordinador en una sola pasada. Es un lookahead
+# para que los matches puedan solaparse ("Director: X Subdirectora: Y" en
+# una misma línea da los dos, como con tres búsquedas separadas)
+_EQUIPO = re.compile(r'(?=(?P<rol>Director|Subdirector|Coordinador)[a]?[:\s]+(?P<nombre>[A-ZÁ-Ú][^\n\r]+))')
+_EMAIL = re.compile(r'([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})')
+_PRESENCIAL = re.compile(r'presencial', re.IGNORECASE)
+_VIRTUAL = re.compile(r'virtual|distancia', re.IGNORECASE)
+_HORARIO = re.compile(r'(lunes|martes|miércoles|jueves|viernes)[^\n]*(\d{1,2}:\d{2}|\d{1,2}hs)', re.IGNORECASE)
+_CICLOS = re.compile(r'(Primer|Segundo|Tercer)\s+[Cc]iclo[:\s]+(\d+)\s*horas?')
+_MATERIA = re.compile(r'\d+\.\s+([A-ZÁ-Ú][^\n\r\.]+?)(?:\.|\n|\()')
+# Horas que siguen al nombre de una materia (se aplica desde el final del match)
+_HORAS_SIGUIENTES = re.compile(r'[^\d]*(\d+)\s*horas?', re.IGNORECASE)
+_ITEM_REQUISITO = re.compile(r'[•\-\d]+\.\s+([^\n]{20,200})')
+_OBJETIVOS = re.compile(r'Objetivos?[:\s]+(.{100,1000})', re.IGNORECASE | re.DOTALL)
+# Tramo de texto, desde cada "objetivo", sobre el que se prueba _OBJETIVOS
+VENTANA_OBJETIVOS = 2000
+
+# Se quitan antes de extraer texto: scripts, estilos y el boilerplate que se
+# repite en todas las páginas del sitio (menús, sidebars, pie)
+TAGS_DESCARTADOS = ['script', 'style', 'nav', 'aside', 'footer']
+
+def parsear_html(html):
+    """Árbol del HTML (parser en C de selectolax) sin scripts, estilos ni boilerplate"""
+    arbol = LexborHTMLParser(html)
+    arbol.strip_tags(TAGS_DESCARTADOS)
+    return arbol
+
+def texto_visible(arbol):
+    """Texto del <body> tal cual aparece (con sus saltos de línea)"""
+    return arbol.body.text(separator='', strip=False) if arbol.body else ''
+
 def limpiar_texto(texto):
     """Limpia y normaliza texto"""
     if not texto:
         return ""
-    texto = re.sub(r'\s+', ' ', texto)
-    texto = texto.strip()
-    return texto
+    return _ESPACIOS.sub(' ', texto).strip()
 
 def extraer_horas(texto):
     """Extrae número de horas del texto"""
-    match = re.search(r'(\d+)\s*horas?', texto, re.IGNORECASE)
+    match = _HORAS.search(texto)
     return int(match.group(1)) if match else None
 
 def extraer_años(texto):
     """Extrae duración en años"""
-    match = re.search(r'(\d+(?:\.\d+)?)\s*años?', texto, re.IGNORECASE)
+    match = _AÑOS.search(texto)
     return float(match.group(1)) if match else None
 
+def a_utf8(crudo, charset=None):
+    """
+    Bytes de la respuesta como UTF-8 válido. El HTML viaja como bytes hasta
+    el parser: solo se decodifica (y recodifica) si no es UTF-8
+    """
+    charset = (charset or 'utf-8').lower()
+    if charset in ('utf-8', 'utf8'):
+        if crudo.isascii():
+            return crudo
+        try:
+            crudo.decode('utf-8')
+            return crudo
+        except UnicodeDecodeError:
+            pass
+    try:
+        return crudo.decode(charset, errors='replace').encode('utf-8')
+    except LookupError:
+        return crudo.decode('utf-8', errors='replace').encode('utf-8')
+
+async def leer_cuerpo(response, limite=MAX_BYTES_PAGINA):
+    """
+    Cuerpo de la respuesta hasta `limite` bytes. content.read(n) devuelve lo
+    que ya llegó, no n bytes: se leen chunks hasta el EOF o hasta el tope
+    """
+    partes, total = [], 0
+    async for parte in response.content.iter_chunked(64 * 1024):
+        partes.append(parte)
+        total += len(parte)
+        if total >= limite:
+            break
+    return b''.join(partes)[:limite]
+
 def calcular_hash(contenido):
-    """Calcula SHA256 del contenido"""
-    return hashlib.sha256(contenido.encode('utf-8')).hexdigest()
+    """Hash rápido (xxh3_128) del HTML (bytes), para detectar cambios"""
+    return xxhash.xxh3_128_hexdigest(contenido)
+
+def comprimir_html(html):
+    """HTML (bytes) comprimido con zstd para guardar en CacheScraping"""
+    return _compresor.compress(html)
+
+def descomprimir_html(contenido):
+    """Inversa de comprimir_html"""
+    return _descompresor.decompress(contenido)
+
+def cargar_paginas_guardadas(db_session, ttl_horas=CACHE_PAGINAS_HORAS):
+    """Carga desde CacheScraping el HTML y los validadores HTTP de las páginas ya scrapeadas"""
+    _paginas_guardadas.clear()
+    limite = datetime.now() - timedelta(hours=ttl_horas)
+    filas = db_session.query(CacheScraping).filter(
+        CacheScraping.contenido_html != None,
+        CacheScraping.status_code == 200
+    )
+    for row in filas:
+        vigente = ttl_horas > 0 and row.fecha_scraping is not None and row.fecha_scraping > limite
+        _paginas_guardadas[row.url] = (
+            row.etag, row.last_modified, descomprimir_html(row.contenido_html), vigente
+        )
 
 # ============== SCRAPERS ESPECÍFICOS ==============
 
+class LimitadorTasa:
+    """Token bucket: hasta `tasa` pedidos por segundo, con ráfagas de `tasa`"""
+
+    def __init__(self, tasa):
+        self.tasa = tasa
+        self.tokens = tasa
+        self.actualizado = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        async with self._lock:
+            while True:
+                ahora = time.monotonic()
+                self.tokens = min(self.tasa, self.tokens + (ahora - self.actualizado) * self.tasa)
+                self.actualizado = ahora
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return self
+                await asyncio.sleep((1 - self.tokens) / self.tasa)
+
+    async def __aexit__(self, *exc):
+        return False
+
+_limitador = LimitadorTasa(PEDIDOS_POR_SEGUNDO)
+
+def segundos_retry_after(valor):
+    """Segundos a esperar según Retry-After (entero o fecha HTTP); None si no vino"""
+    if not valor:
+        return None
+    try:
+        segundos = float(valor)
+    except ValueError:
+        try:
+            fecha = parsedate_to_datetime(valor)
+        except (TypeError, ValueError):
+            return None
+        segundos = (fecha - datetime.now(fecha.tzinfo)).total_seconds()
+    return min(max(segundos, 0), MAX_RETRY_AFTER)
+
 async def fetch_url(session, url):
-    """Fetch async con retry"""
-    for intento in range(3):
+    """
+    Fetch async con retry. Si la página está en CacheScraping y vigente no
+    se pide; si está pero vencida, se pide condicionalmente (ETag / Last-Modified)
+    """
+    guardada = _paginas_guardadas.get(url)
+    headers = {}
+    if guardada:
+        etag, last_modified, html, vigente = guardada
+        if vigente:
+            return html, 200
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+    
+    for intento in range(MAX_INTENTOS):
+        espera = None
         try:
-            async with session.get(url, timeout=15) as response:
+            async with _semaforo, _limitador, session.get(url, headers=headers) as response:
                 if response.status == 200:
-                    html = await response.text()
+                    crudo = await leer_cuerpo(response)
+                    html = a_utf8(crudo, response.charset)
+                    _paginas_descargadas[url] = (
+                        html, response.status,
+                        response.headers.get('ETag'), response.headers.get('Last-Modified')
+                    )
                     return html, response.status
-                elif response.status == 404:
-                    return None, 404
-        except Exception as e:
-            if intento == 2:
-                print(f"❌ Error fetching {url}: {e}")
-                return None, 0
-            await asyncio.sleep(2)
+                elif response.status == 304 and guardada:
+                    # Sin cambios: no viaja el cuerpo, se usa el HTML guardado
+                    etag, last_modified, html, _ = guardada
+                    _paginas_descargadas[url] = (html, 200, etag, last_modified)
+                    return html, 200
+                elif response.status != 429 and response.status < 500:
+                    # 404 y demás 4xx no cambian reintentando
+                    return None, response.status
+                # 429/5xx: se respeta Retry-After si vino, si no backoff
+                espera = segundos_retry_after(response.headers.get('Retry-After'))
+                error = f"HTTP {response.status}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = str(e) or type(e).__name__
+        if intento == MAX_INTENTOS - 1:
+            print(f"❌ Error fetching {url}: {error}")
+            return None, 0
+        # Backoff exponencial con jitter: 1-2 s, 2-3 s, ...
+        await asyncio.sleep(espera if espera is not None else (2 ** intento) + random.random())
     return None, 0
 
 async def scrape_pagina_principal(session, nombre_corto, tipo):
@@ -118,7 +362,12 @@ async def scrape_pagina_principal(session, nombre_corto, tipo):
     if not html:
         return None
     
-    soup = BeautifulSoup(html, 'html.parser')
+    # El parseo es CPU: va a un thread para no frenar las otras descargas
+    return await asyncio.to_thread(parsear_pagina_principal, html, url, nombre_corto, tipo)
+
+def parsear_pagina_principal(html, url, nombre_corto, tipo):
+    """Parsea la página principal del programa"""
+    arbol = parsear_html(html)
     
     datos = {
         'tipo': tipo,
@@ -135,30 +384,23 @@ async def scrape_pagina_principal(session, nombre_corto, tipo):
     }
     
     # Extraer título/nombre
-    titulo = soup.find('h1') or soup.find('h2')
+    titulo = arbol.css_first('h1') or arbol.css_first('h2')
     if titulo:
-        datos['nombre'] = limpiar_texto(titulo.get_text())
+        datos['nombre'] = limpiar_texto(titulo.text())
     
     # Extraer equipo directivo
-    texto_completo = soup.get_text()
-    
-    # Director
-    match_dir = re.search(r'Director[a]?[:\s]+([A-ZÁ-Ú][^\n\r]+)', texto_completo)
-    if match_dir:
-        datos['director'] = limpiar_texto(match_dir.group(1).split('\n')[0])
-    
-    # Subdirector
-    match_sub = re.search(r'Subdirector[a]?[:\s]+([A-ZÁ-Ú][^\n\r]+)', texto_completo)
-    if match_sub:
-        datos['subdirector'] = limpiar_texto(match_sub.group(1).split('\n')[0])
-    
-    # Coordinador
-    match_coord = re.search(r'Coordinador[a]?[:\s]+([A-ZÁ-Ú][^\n\r]+)', texto_completo)
-    if match_coord:
-        datos['coordinador'] = limpiar_texto(match_coord.group(1).split('\n')[0])
-    
-    # Email
-    match_email = re.search(r'([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})', texto_completo)
+    texto_completo = texto_visible(arbol)
+    
+    # Director, subdirector, coordinador (vale la primera aparición de cada uno)
+    for match in _EQUIPO.finditer(texto_completo):
+        rol = match['rol'].lower()
+        if not datos[rol]:
+            datos[rol] = limpiar_texto(match['nombre'])
+    
+    # Email: primero el link mailto (dato estructurado), si no lo hay se busca en el texto
+    mailto = arbol.css_first('a[href^="mailto:"]')
+    email = _EMAIL.search(mailto.attributes.get('href') or '') if mailto else None
+    match_email = email or _EMAIL.search(texto_completo)
     if match_email:
         datos['email'] = match_email.group(1)
     
@@ -173,13 +415,13 @@ async def scrape_pagina_principal(session, nombre_corto, tipo):
         datos['carga_horaria_total'] = horas
     
     # Modalidad
-    if re.search(r'presencial', texto_completo, re.IGNORECASE):
+    if _PRESENCIAL.search(texto_completo):
         datos['modalidad'] = 'presencial'
-    elif re.search(r'virtual|distancia', texto_completo, re.IGNORECASE):
+    elif _VIRTUAL.search(texto_completo):
         datos['modalidad'] = 'virtual'
     
     # Horario
-    match_horario = re.search(r'(lunes|martes|miércoles|jueves|viernes)[^\n]*(\d{1,2}:\d{2}|\d{1,2}hs)', texto_completo, re.IGNORECASE)
+    match_horario = _HORARIO.search(texto_completo)
     if match_horario:
         datos['horario_cursada'] = limpiar_texto(match_horario.group(0)[:100])
     
@@ -193,37 +435,39 @@ async def scrape_plan_estudios(session, nombre_corto):
     if not html:
         return [], None
     
-    soup = BeautifulSoup(html, 'html.parser')
-    texto = soup.get_text()
+    return await asyncio.to_thread(parsear_plan_estudios, html)
+
+def parsear_plan_estudios(html):
+    """Parsea el plan de estudios: (materias, estructura_json)"""
+    texto = texto_visible(parsear_html(html))
     
     materias = []
     estructura = {}
     
     # Detectar ciclos
-    match_ciclos = re.findall(r'(Primer|Segundo|Tercer)\s+[Cc]iclo[:\s]+(\d+)\s*horas?', texto)
-    if match_ciclos:
-        estructura['ciclos'] = [{'nombre': c[0], 'horas': int(c[1])} for c in match_ciclos]
-    
-    # Extraer materias
-    patron_materias = r'\d+\.\s+([A-ZÁ-Ú][^\n\r\.]+?)(?:\.|\n|\()'
-    matches = re.findall(patron_materias, texto)
-    
-    for nombre_mat in matches:
-        nombre_limpio = limpiar_texto(nombre_mat)
-        if len(nombre_limpio) > 5 and len(nombre_limpio) < 200:
-            patron_horas = rf'{re.escape(nombre_limpio)}[^\d]*(\d+)\s*horas?'
-            match_horas = re.search(patron_horas, texto, re.IGNORECASE)
-            horas = int(match_horas.group(1)) if match_horas else None
-            
-            tipo_materia = 'optativa' if 'optativa' in texto.lower() else 'troncal'
-            
-            materias.append({
-                'nombre': nombre_limpio,
-                'carga_horaria': horas,
-                'tipo': tipo_materia
-            })
-    
-    return materias, json.dumps(estructura) if estructura else None
+    ciclos = [{'nombre': c[1], 'horas': int(c[2])} for c in _CICLOS.finditer(texto)]
+    if ciclos:
+        estructura['ciclos'] = ciclos
+    
+    # Extraer materias: las horas se buscan a partir de donde termina cada
+    # nombre, sin volver a recorrer el texto desde el principio por materia
+    tipo_materia = 'optativa' if 'optativa' in texto.lower() else 'troncal'
+    
+    for match in _MATERIA.finditer(texto):
+        nombre_limpio = limpiar_texto(match.group(1))
+        if not 5 < len(nombre_limpio) < 200:
+            continue
+        
+        match_horas = _HORAS_SIGUIENTES.match(texto, match.end(1))
+        horas = int(match_horas.group(1)) if match_horas else None
+        
+        materias.append({
+            'nombre': nombre_limpio,
+            'carga_horaria': horas,
+            'tipo': tipo_materia
+        })
+    
+    return materias, orjson.dumps(estructura).decode() if estructura else None
 
 async def scrape_requisitos(session, nombre_corto):
     """Extrae requisitos de admisión"""
@@ -233,19 +477,23 @@ async def scrape_requisitos(session, nombre_corto):
     if not html:
         return None
     
-    soup = BeautifulSoup(html, 'html.parser')
+    return await asyncio.to_thread(parsear_requisitos, html)
+
+def parsear_requisitos(html):
+    """Parsea los requisitos de admisión (JSON)"""
+    arbol = parsear_html(html)
     
     requisitos = []
     
-    items = soup.find_all('li')
+    items = arbol.css('li')
     if items:
-        requisitos = [limpiar_texto(li.get_text()) for li in items if len(li.get_text()) > 10]
+        # Cada <li> se recorre y limpia una sola vez; el largo se mide ya limpio
+        requisitos = [t for li in items if len(t := limpiar_texto(li.text())) > 10]
     else:
-        texto = soup.get_text()
-        matches = re.findall(r'[•\-\d]+\.\s+([^\n]{20,200})', texto)
-        requisitos = [limpiar_texto(m) for m in matches]
+        texto = texto_visible(arbol)
+        requisitos = [limpiar_texto(m[1]) for m in _ITEM_REQUISITO.finditer(texto)]
     
-    return json.dumps(requisitos, ensure_ascii=False) if requisitos else None
+    return orjson.dumps(requisitos).decode() if requisitos else None
 
 async def scrape_objetivos(session, nombre_corto):
     """Extrae objetivos del programa"""
@@ -255,45 +503,78 @@ async def scrape_objetivos(session, nombre_corto):
     if not html:
         return None
     
-    soup = BeautifulSoup(html, 'html.parser')
-    texto = soup.get_text()
-    
-    match = re.search(r'Objetivos?[:\s]+(.{100,1000})', texto, re.IGNORECASE | re.DOTALL)
-    if match:
-        return limpiar_texto(match.group(1))
-    
-    parrafos = [p for p in texto.split('\n') if len(p) > 100]
-    return limpiar_texto(parrafos[0]) if parrafos else None
+    return await asyncio.to_thread(parsear_objetivos, html)
+
+def parsear_objetivos(html):
+    """Parsea los objetivos del programa"""
+    texto = texto_visible(parsear_html(html))
+    
+    # _OBJETIVOS solo se prueba donde aparece "objetivo" (str.find), acotado
+    # a una ventana, en vez de intentarlo en cada posición de todo el texto
+    minusculas = texto.lower()
+    inicio = minusculas.find('objetivo')
+    while inicio >= 0:
+        match = _OBJETIVOS.match(texto, inicio, inicio + VENTANA_OBJETIVOS)
+        if match:
+            return limpiar_texto(match.group(1))
+        inicio = minusculas.find('objetivo', inicio + 1)
+    
+    parrafo = _PARRAFO_LARGO.search(texto)
+    return limpiar_texto(parrafo.group()) if parrafo else None
 
 # ============== SCRAPER PRINCIPAL ==============
 
 async def scrape_programa_completo(session, nombre_corto, tipo, db_session):
     """Scrape completo de un programa (5 páginas)"""
+    descargado = await descargar_programa(session, nombre_corto, tipo)
+    if not descargado:
+        return None
+    return await asyncio.to_thread(guardar_programa, db_session, *descargado)
+
+async def descargar_programa(session, nombre_corto, tipo):
+    """Descarga y parsea las páginas de un programa: (datos, materias) o None"""
     print(f"📝 Scraping: {nombre_corto}...")
     
-    datos = await scrape_pagina_principal(session, nombre_corto, tipo)
+    # Las 4 páginas son independientes: se descargan en paralelo. Un error
+    # de parseo en una página no tira las demás (ni al resto de los programas)
+    resultados = await asyncio.gather(
+        scrape_pagina_principal(session, nombre_corto, tipo),
+        scrape_plan_estudios(session, nombre_corto),
+        scrape_requisitos(session, nombre_corto),
+        scrape_objetivos(session, nombre_corto),
+        return_exceptions=True
+    )
+    for error in resultados:
+        if isinstance(error, Exception):
+            print(f"   ❌ Error parseando {nombre_corto}: {error}")
+    
+    datos, plan, requisitos, objetivos = (
+        None if isinstance(r, Exception) else r for r in resultados
+    )
+    materias, estructura = plan or ([], None)
+    
     if not datos:
         print(f"   ⚠️  No se pudo obtener datos principales")
         return None
     
-    materias, estructura = await scrape_plan_estudios(session, nombre_corto)
     if estructura:
         datos['estructura_ciclos'] = estructura
     
-    requisitos = await scrape_requisitos(session, nombre_corto)
     if requisitos:
         datos['requisitos'] = requisitos
     
-    objetivos = await scrape_objetivos(session, nombre_corto)
     if objetivos:
         datos['objetivos'] = objetivos
     
+    return datos, materias
+
+def guardar_programa(db_session, datos, materias):
+    """Guarda un programa descargado y sus materias; retorna su id"""
     try:
         programa_id = agregar_programa(db_session, datos)
         print(f"   ✅ Programa guardado ID={programa_id}")
         
-        for materia in materias:
-            agregar_materia(db_session, programa_id, materia)
+        agregar_materias(db_session, programa_id, materias)
         
         print(f"   ✅ {len(materias)} materias guardadas")
         
@@ -302,28 +583,109 @@ async def scrape_programa_completo(session, nombre_corto, tipo, db_session):
         print(f"   ❌ Error guardando: {e}")
         return None
 
-async def scrape_todo():
-    """Scraper principal - extrae TODOS los programas"""
+def guardar_paginas_en_cache(db_session):
+    """
+    Guarda en CacheScraping las páginas descargadas; las que no cambiaron no
+    se reescriben, solo se marcan como verificadas (fecha_scraping)
+    """
+    if not _paginas_descargadas:
+        return
+    
+    existentes = {
+        row.url: row
+        for row in db_session.query(CacheScraping).filter(
+            CacheScraping.url.in_(list(_paginas_descargadas))
+        )
+    }
+    
+    cambiadas = 0
+    for url, (html, status, etag, last_modified) in _paginas_descargadas.items():
+        hash_contenido = calcular_hash(html)
+        row = existentes.get(url)
+        if row and row.hash_contenido == hash_contenido:
+            row.etag, row.last_modified = etag, last_modified
+            row.fecha_scraping = datetime.now()
+            continue
+        
+        if not row:
+            row = CacheScraping(url=url)
+            db_session.add(row)
+        row.etag, row.last_modified = etag, last_modified
+        row.contenido_html = comprimir_html(html)
+        row.hash_contenido = hash_contenido
+        row.fecha_scraping = datetime.now()
+        row.status_code = status
+        cambiadas += 1
+    
+    db_session.commit()
+    print(f"\n💾 Cache: {cambiadas} de {len(_paginas_descargadas)} páginas nuevas o modificadas")
+
+async def calcular_embeddings(db_session):
+    """Embeddings (búsqueda semántica del RAG) de los programas que todavía no tienen"""
+    if not os.getenv('OPENAI_API_KEY'):
+        print("\n⚠️  OPENAI_API_KEY no configurada: se omiten los embeddings")
+        return
+    
+    from ai_engine import embeber, texto_para_embedding, EMBEDDING_MODELO
+    
+    programas = db_session.query(Programa).outerjoin(
+        EmbeddingPrograma,
+        (EmbeddingPrograma.programa_id == Programa.id) & (EmbeddingPrograma.modelo == EMBEDDING_MODELO)
+    ).filter(EmbeddingPrograma.programa_id == None).all()
+    
+    if not programas:
+        return
+    
+    print(f"\n🧠 Calculando embeddings de {len(programas)} programas...")
+    try:
+        vectores = await embeber([texto_para_embedding(p) for p in programas])
+    except Exception as e:
+        print(f"   ❌ Error calculando embeddings: {e}")
+        return
+    
+    for programa, vector in zip(programas, vectores):
+        db_session.merge(EmbeddingPrograma(programa_id=programa.id, modelo=EMBEDDING_MODELO, vector=vector))
+    db_session.commit()
+    print(f"   ✅ {len(vectores)} embeddings guardados")
+
+async def scrape_todo(forzar=False):
+    """
+    Scraper principal - extrae TODOS los programas
+    forzar: pedir todas las páginas aunque estén vigentes en CacheScraping
+    """
     print("🚀 INICIANDO SCRAPING EXHAUSTIVO")
     print("="*60)
     
     engine, db_session = init_database()
+    _paginas_descargadas.clear()
+    cargar_paginas_guardadas(db_session, ttl_horas=0 if forzar else CACHE_PAGINAS_HORAS)
     
-    async with aiohttp.ClientSession() as session:
-        
-        print(f"\n📚 MAESTRÍAS ({len(MAESTRIAS_LIST)} programas)")
-        print("-"*60)
-        
-        for nombre in MAESTRIAS_LIST:
-            await scrape_programa_completo(session, nombre, 'maestria', db_session)
-            await asyncio.sleep(0.5)
-        
-        print(f"\n🎯 ESPECIALIZACIONES ({len(ESPECIALIZACIONES_LIST)} programas)")
-        print("-"*60)
-        
-        for nombre in ESPECIALIZACIONES_LIST:
-            await scrape_programa_completo(session, nombre, 'especializacion', db_session)
-            await asyncio.sleep(0.5)
+    print(f"\n📚 MAESTRÍAS ({sum(tipo == 'maestria' for _, tipo in PROGRAMAS)} programas)")
+    print(f"🎯 ESPECIALIZACIONES ({sum(tipo == 'especializacion' for _, tipo in PROGRAMAS)} programas)")
+    print("-"*60)
+    
+    # Todos los programas se descargan a la vez; el semáforo y el límite
+    # por host del connector son los que mantienen la carga sobre el sitio
+    session = obtener_sesion()
+    en_curso = asyncio.Semaphore(MAX_PROGRAMAS_SIMULTANEOS)
+    
+    async def descargar(nombre, tipo):
+        async with en_curso:
+            return await descargar_programa(session, nombre, tipo)
+    
+    tareas = [asyncio.create_task(descargar(nombre, tipo)) for nombre, tipo in PROGRAMAS]
+    
+    # Un solo escritor: cada programa se guarda (en un thread, SQLAlchemy es
+    # sincrónico) apenas está listo y mientras siguen las otras descargas.
+    # Se respeta el orden de las listas para que los ids no dependan de qué
+    # descarga terminó primero
+    for tarea in tareas:
+        descargado = await tarea
+        if descargado:
+            await asyncio.to_thread(guardar_programa, db_session, *descargado)
+    
+    await asyncio.to_thread(guardar_paginas_en_cache, db_session)
+    await calcular_embeddings(db_session)
     
     print("\n" + "="*60)
     print("✅ SCRAPING COMPLETO")
@@ -336,11 +698,33 @@ async def scrape_todo():
     print(f"   Maestrías: {stats['total_maestrias']}")
     print(f"   Especializaciones: {stats['total_especializaciones']}")
     print(f"   Total materias: {stats['total_materias']}")
-    print(f"   Promedio materias/programa: {stats['total_materias'] / stats['total_programas']:.1f}")
+    if stats['total_programas']:
+        print(f"   Promedio materias/programa: {stats['total_materias'] / stats['total_programas']:.1f}")
 
 # ============== EJECUTAR ==============
 
+def datos_vigentes():
+    """True si la BD ya tiene programas scrapeados hace menos de SCRAPE_TTL_HORAS"""
+    engine, db_session = init_database()
+    try:
+        ultima = db_session.query(func.max(Programa.ultima_actualizacion)).scalar()
+    finally:
+        db_session.close()
+    return ultima is not None and datetime.now() - ultima < timedelta(hours=SCRAPE_TTL_HORAS)
+
+async def main(forzar=False):
+    try:
+        await scrape_todo(forzar)
+    finally:
+        await cerrar_sesion()
+
 if __name__ == "__main__":
-    asyncio.run(scrape_todo())
+    # --forzar: scrapear aunque los datos (y las páginas cacheadas) estén vigentes
+    forzar = '--forzar' in sys.argv
+    if not forzar and datos_vigentes():
+        print(f"✅ Datos scrapeados hace menos de {SCRAPE_TTL_HORAS:g} horas: se omite el scraping")
+        sys.exit(0)
+    
+    asyncio.run(main(forzar))
     print("\n✅ Datos guardados en: posgrados_uba.db")
     print("🎉 ¡Listo para usar!")